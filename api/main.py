@@ -1,17 +1,28 @@
+import asyncio
 import os
 import re
 import time
 import base64
+import hashlib
 import io
 import json
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import quote
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+import orjson
 import pyodbc
 import httpx
-from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
 
 
@@ -38,8 +49,27 @@ PDF_URL_COLUMN = env("PDF_URL_COLUMN", "pdfWebUrl")
 STATUS_COLUMN = env("STATUS_COLUMN", "Status")
 CLIENT_COLUMN = env("CLIENT_COLUMN", "Klient")
 
+# Optional comma-separated projection for /orders; when unset, the list
+# view returns every column except the sourceQuote blob.
+ORDERS_LIST_COLUMNS = os.getenv("ORDERS_LIST_COLUMNS", "")
+
 CORS_ALLOW_ORIGINS = env("CORS_ALLOW_ORIGINS", "*")
 PDF_MAX_PAGES_SCAN = int(env("PDF_MAX_PAGES_SCAN", "50"))
+PDF_MAX_BYTES = int(env("PDF_MAX_BYTES", str(100 * 1024 * 1024)))
+PDF_CHUNK_TIMEOUT = float(env("PDF_CHUNK_TIMEOUT", "10"))
+# In-process PDF cache: total budget and per-item ceiling (bytes); a total
+# budget of 0 disables the cache entirely.
+PDF_CACHE_MAX_BYTES = int(env("PDF_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+PDF_CACHE_MAX_ITEM_BYTES = int(env("PDF_CACHE_MAX_ITEM_BYTES", str(16 * 1024 * 1024)))
+POOL_SIZE = int(env("POOL_SIZE", "5"))
+DB_MAX_WORKERS = int(env("DB_MAX_WORKERS", "8"))
+
+# Microsoft Graph credentials — optional (legacy ?url= mode works without
+# them), so read once here rather than per request; empty means unset.
+MS_DRIVE_ID = os.getenv("MS_DRIVE_ID", "").strip()
+MS_TENANT_ID = os.getenv("MS_TENANT_ID", "").strip()
+MS_CLIENT_ID = os.getenv("MS_CLIENT_ID", "").strip()
+MS_CLIENT_SECRET = os.getenv("MS_CLIENT_SECRET", "").strip()
 
 
 def build_conn_str() -> str:
@@ -55,11 +85,125 @@ def build_conn_str() -> str:
     )
 
 
-def get_conn():
+# --------------------------
+# Connection pool
+# --------------------------
+# A fresh pyodbc.connect() pays a full TCP + TLS + SQL login handshake,
+# which dominates latency on the short endpoints. Keep up to POOL_SIZE
+# warm connections and hand them out per request. Pooling happens here in
+# Python — unixODBC's own connection pooling is known to leak, so keep the
+# driver-manager variant off explicitly.
+pyodbc.pooling = False
+
+# LIFO: prefer the most recently used connection, which is the one least
+# likely to have been idled out by the server or a firewall.
+_pool: "queue.LifoQueue[pyodbc.Connection]" = queue.LifoQueue(maxsize=POOL_SIZE)
+
+
+def _connect() -> pyodbc.Connection:
     try:
-        return pyodbc.connect(build_conn_str())
+        conn = pyodbc.connect(build_conn_str())
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB connect failed: {e}")
+    # msodbcsql on Linux talks UTF-8; telling pyodbc up front skips the
+    # per-value UTF-16 round-trip when encoding parameters.
+    conn.setencoding(encoding="utf-8")
+    return conn
+
+
+def _conn_is_dead(conn: pyodbc.Connection) -> bool:
+    try:
+        return bool(conn.getinfo(pyodbc.SQL_CONNECTION_DEAD))
+    except Exception:
+        return True
+
+
+# Per-connection cursors keyed by statement text. Re-executing the same SQL
+# on the same cursor lets pyodbc skip SQLPrepare, so SQL Server serves the
+# canonical statements (get/update/list) from its cached plan instead of
+# recompiling per request. Keyed by id(conn); entries die with the pool's
+# _discard. Bounded: ?fields= feeds client-controlled statement text here,
+# which must not pin ODBC statement handles for the connection's lifetime.
+_stmt_cursors: Dict[int, Dict[str, pyodbc.Cursor]] = {}
+STMT_CACHE_MAX = int(env("STMT_CACHE_MAX", "32"))
+
+
+# Rows per fetchmany() batch in the NDJSON export. pyodbc only uses
+# arraysize as the fetchmany() default — it does no ODBC block fetch — so
+# there is nothing to tune for the fetchall() paths.
+FETCH_ARRAY_SIZE = int(env("FETCH_ARRAY_SIZE", "500"))
+
+
+def exec_prepared(conn: pyodbc.Connection, sql: str, params) -> pyodbc.Cursor:
+    cache = _stmt_cursors.setdefault(id(conn), {})
+    cur = cache.get(sql)
+    if cur is None:
+        if len(cache) >= STMT_CACHE_MAX:
+            # Evict the oldest entry (dicts preserve insertion order) and
+            # close its cursor so the statement handle is freed.
+            try:
+                cache.pop(next(iter(cache))).close()
+            except Exception:
+                pass
+        cur = conn.cursor()
+        cache[sql] = cur
+    cur.execute(sql, params)
+    return cur
+
+
+def _discard(conn: pyodbc.Connection) -> None:
+    _stmt_cursors.pop(id(conn), None)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _release(conn: pyodbc.Connection) -> None:
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        _discard(conn)
+
+
+# Dedicated executor for blocking pyodbc work: caps DB concurrency
+# explicitly instead of queueing through (and starving) the default
+# Starlette threadpool that also serves sync endpoints.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, fn, *args)
+
+
+@contextmanager
+def get_conn():
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    else:
+        if _conn_is_dead(conn):
+            _discard(conn)
+            conn = _connect()
+    try:
+        yield conn
+    except Exception:
+        # Mirror pyodbc's `with connection` semantics: roll back on error.
+        try:
+            conn.rollback()
+        except Exception:
+            _discard(conn)
+            raise
+        _release(conn)
+        raise
+    else:
+        try:
+            conn.commit()
+        except Exception:
+            _discard(conn)
+            raise
+        _release(conn)
 
 
 IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
@@ -73,7 +217,17 @@ def parse_schema_table(fully_qualified: str) -> Tuple[str, str]:
     return schema, table
 
 
+# Identifiers seen at runtime come from a closed set (live table columns +
+# configured names). Once the metadata cache is warm, quoting is a single
+# dict probe; the regex only runs for names outside the set.
+_KNOWN_IDENTS: frozenset = frozenset()
+_SAFE_IDENT_SQL: Dict[str, str] = {}
+
+
 def safe_ident(name: str) -> str:
+    quoted = _SAFE_IDENT_SQL.get(name)
+    if quoted is not None:
+        return quoted
     if not IDENT_RE.match(name):
         raise HTTPException(status_code=400, detail=f"Invalid identifier: {name}")
     return f"[{name}]"
@@ -86,6 +240,82 @@ def safe_table(fully_qualified: str) -> str:
     return f"[{schema}].[{table}]"
 
 
+# Identifiers configured via env never change at runtime — validate and
+# quote them once at import instead of re-running the regex per request.
+# This also surfaces a bad identifier at startup rather than on first use.
+TABLE_SQL = safe_table(MSSQL_TABLE)
+PK_SQL = safe_ident(MSSQL_PK)
+STATUS_SQL = safe_ident(STATUS_COLUMN)
+CLIENT_SQL = safe_ident(CLIENT_COLUMN)
+
+
+# --------------------------
+# Prebuilt SQL templates
+# --------------------------
+# The statement text only varies with which filters are active, so build
+# each permutation once instead of re-joining fragments per request.
+GET_ORDER_SQL = f"SELECT * FROM {TABLE_SQL} WHERE {PK_SQL} = ?;"
+UPDATE_STATUS_SQL = f"UPDATE {TABLE_SQL} SET {STATUS_SQL} = ? WHERE {PK_SQL} = ?;"
+
+ORDERS_ORDER_BY = "ORDER BY [Klient] ASC, [pdfFileName] ASC, [Pozycja] ASC"
+
+# Whitelist pól edytowalnych z UI (patch_order) — quoted once at import.
+# Jeśli kiedyś: dopisać "OfertaWaluta".
+PATCH_ALLOWED_SQL = {
+    k: safe_ident(k)
+    for k in ("Klient", "FinalIndeks", "NazwaKlienta", "IloscKlienta", "CenaOfertowa")
+}
+
+
+@lru_cache(maxsize=4)
+def orders_select_list(cols_key: Tuple[str, ...]) -> str:
+    # Project only what the list view needs: SELECT * drags every column
+    # (including big NVARCHAR blobs like sourceQuote) over TDS on each page.
+    # /orders/{id} keeps SELECT * for the detail view.
+    if ORDERS_LIST_COLUMNS:
+        existing = set(cols_key)
+        picked = [
+            c.strip() for c in ORDERS_LIST_COLUMNS.split(",")
+            if c.strip() and c.strip() in existing
+        ]
+        if picked and MSSQL_PK not in picked and MSSQL_PK in existing:
+            # next_cursor reads the PK of the last row; keep cursor
+            # pagination working even if the configured list omits it.
+            picked.append(MSSQL_PK)
+    else:
+        picked = [c for c in cols_key if c != SOURCEQUOTE_COLUMN]
+    if not picked:
+        return "*"
+    return ", ".join(safe_ident(c) for c in picked)
+
+
+@lru_cache(maxsize=16)
+def build_orders_sql(select_list: str, has_status: bool, has_klient: bool) -> Tuple[str, str, str, str]:
+    where = []
+    if has_status:
+        where.append(f"{STATUS_SQL} = ?")
+    if has_klient:
+        where.append(f"{CLIENT_SQL} LIKE ?")
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+
+    count_sql = f"SELECT COUNT(1) AS cnt FROM {TABLE_SQL}{where_sql};"
+    items_sql = (
+        f"SELECT {select_list} FROM {TABLE_SQL}{where_sql} "
+        f"{ORDERS_ORDER_BY} "
+        f"OFFSET ? ROWS FETCH NEXT ? ROWS ONLY;"
+    )
+    # Windowed variant: COUNT(*) OVER() returns the filtered total with the
+    # page rows themselves — one scan, one round-trip.
+    items_win_sql = (
+        f"SELECT {select_list}, COUNT(*) OVER() AS _total FROM {TABLE_SQL}{where_sql} "
+        f"{ORDERS_ORDER_BY} "
+        f"OFFSET ? ROWS FETCH NEXT ? ROWS ONLY;"
+    )
+    seek_where = " AND ".join(where + [f"{PK_SQL} < ?"])
+    seek_sql = f"SELECT TOP (?) {select_list} FROM {TABLE_SQL} WHERE {seek_where} ORDER BY {PK_SQL} DESC;"
+    return count_sql, items_sql, items_win_sql, seek_sql
+
+
 def fetch_table_columns() -> List[str]:
     schema, table = parse_schema_table(MSSQL_TABLE)
     with get_conn() as conn:
@@ -102,14 +332,125 @@ def fetch_table_columns() -> List[str]:
         return [row[0] for row in cur.fetchall()]
 
 
+# --------------------------
+# Schema metadata cache
+# --------------------------
+# The table schema rarely changes at runtime, so hitting INFORMATION_SCHEMA
+# on every request is a wasted DB round-trip. Populate on startup or first
+# use and re-validate only after SCHEMA_CACHE_TTL seconds (0 disables the
+# TTL entirely); POST /admin/refresh-meta forces a refresh.
+SCHEMA_CACHE_TTL = float(env("SCHEMA_CACHE_TTL", "300"))
+
+_meta_lock = threading.Lock()
+_COLUMNS_CACHE: Optional[List[str]] = None
+_COLS_SET_CACHE: frozenset = frozenset()
+_FLAGS_CACHE: Optional[Dict[str, bool]] = None
+_META_LOADED_AT: float = 0.0
+
+
+def _meta_fresh() -> bool:
+    if _COLUMNS_CACHE is None or _FLAGS_CACHE is None:
+        return False
+    if SCHEMA_CACHE_TTL <= 0:
+        return True
+    return time.monotonic() - _META_LOADED_AT < SCHEMA_CACHE_TTL
+
+
+def get_cached_meta() -> Tuple[List[str], Dict[str, bool]]:
+    global _COLUMNS_CACHE, _FLAGS_CACHE, _META_LOADED_AT
+    if _meta_fresh():
+        return _COLUMNS_CACHE, _FLAGS_CACHE
+    with _meta_lock:
+        if not _meta_fresh():
+            cols = fetch_table_columns()
+            _COLUMNS_CACHE = cols
+            _FLAGS_CACHE = validate_config_columns(cols)
+            global _KNOWN_IDENTS, _COLS_SET_CACHE, _SAFE_IDENT_SQL
+            _COLS_SET_CACHE = frozenset(cols)
+            _KNOWN_IDENTS = _COLS_SET_CACHE | {
+                MSSQL_PK,
+                STATUS_COLUMN,
+                CLIENT_COLUMN,
+                SOURCEQUOTE_COLUMN,
+                PDF_URL_COLUMN,
+            }
+            _SAFE_IDENT_SQL = {c: f"[{c}]" for c in _KNOWN_IDENTS}
+            _META_LOADED_AT = time.monotonic()
+        return _COLUMNS_CACHE, _FLAGS_CACHE
+
+
+def invalidate_meta_cache() -> None:
+    global _COLUMNS_CACHE, _FLAGS_CACHE
+    with _meta_lock:
+        _COLUMNS_CACHE = None
+        _FLAGS_CACHE = None
+
+
+# --------------------------
+# COUNT cache
+# --------------------------
+# On large tables the COUNT for /orders is often slower than the page fetch
+# itself, and the result barely moves between requests. Cache per
+# (sql, params) with a short TTL; the unfiltered total can additionally be
+# answered from sys.dm_db_partition_stats in O(1).
+COUNT_CACHE_TTL = float(env("COUNT_CACHE_TTL", "30"))
+COUNT_CACHE_MAX = int(env("COUNT_CACHE_MAX", "1024"))
+
+_count_lock = threading.Lock()
+_COUNT_CACHE: Dict[Tuple[str, Tuple[Any, ...]], Tuple[int, float]] = {}
+
+APPROX_COUNT_SQL = (
+    "SELECT SUM(row_count) FROM sys.dm_db_partition_stats "
+    "WHERE object_id = OBJECT_ID(?) AND index_id < 2"
+)
+
+
+def count_cache_get(count_sql: str, params: List[Any]) -> Optional[int]:
+    key = (count_sql, tuple(params))
+    with _count_lock:
+        hit = _COUNT_CACHE.get(key)
+        if hit is not None and time.monotonic() - hit[1] < COUNT_CACHE_TTL:
+            return hit[0]
+    return None
+
+
+def count_cache_put(count_sql: str, params: List[Any], total: int) -> None:
+    key = (count_sql, tuple(params))
+    now = time.monotonic()
+    with _count_lock:
+        if len(_COUNT_CACHE) >= COUNT_CACHE_MAX:
+            # Keys embed client-controlled filter values, so the dict must
+            # stay bounded: drop expired entries, then oldest-inserted.
+            for k in [k for k, v in _COUNT_CACHE.items() if now - v[1] >= COUNT_CACHE_TTL]:
+                del _COUNT_CACHE[k]
+            while len(_COUNT_CACHE) >= COUNT_CACHE_MAX:
+                del _COUNT_CACHE[next(iter(_COUNT_CACHE))]
+        _COUNT_CACHE[key] = (total, now)
+
+
+def weak_etag(payload: Any) -> str:
+    digest = hashlib.blake2b(repr(payload).encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}"'
+
+
 def row_to_dict(cursor, row) -> Dict[str, Any]:
     columns = [col[0] for col in cursor.description]
-    return {columns[i]: row[i] for i in range(len(columns))}
+    return dict(zip(columns, row))
+
+
+def rows_to_dicts(cursor, rows) -> List[Dict[str, Any]]:
+    # Compute the column names once per result set, not once per row.
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
 
 # --------------------------
 # Update model (PATCH /orders/{id})
 # --------------------------
 class OrderUpdateRequest(BaseModel):
+    # Pydantic v2 (pinned in requirements); unknown keys are dropped at
+    # validation so patch_order never sees them.
+    model_config = ConfigDict(extra="ignore")
+
     Klient: Optional[str] = None
     FinalIndeks: Optional[str] = None
     NazwaKlienta: Optional[str] = None
@@ -132,7 +473,7 @@ def validate_config_columns(existing_cols: List[str]) -> Dict[str, bool]:
 # -------------
 # FastAPI app
 # -------------
-app = FastAPI(title="Orders MVP API")
+app = FastAPI(title="Orders MVP API", default_response_class=ORJSONResponse)
 
 origins = [o.strip() for o in CORS_ALLOW_ORIGINS.split(",")] if CORS_ALLOW_ORIGINS != "*" else ["*"]
 app.add_middleware(
@@ -143,6 +484,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class _GZipExceptPdf(GZipMiddleware):
+    """GZipMiddleware with /pdf carved out.
+
+    GZipMiddleware does no content-type filtering, so it would recompress
+    already-compressed PDF bytes (CPU for ~0 gain) and replace the
+    forwarded Content-Length with chunked gzip output — which disables
+    PDF.js range mode and defeats the /pdf Range cache.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/pdf":
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+
+# Large /orders pages compress 5-10x thanks to repeated keys; small bodies
+# are skipped entirely. /pdf bypasses compression (see _GZipExceptPdf).
+app.add_middleware(_GZipExceptPdf, minimum_size=1024)
+
+
+@app.on_event("startup")
+async def open_http_client():
+    # One client for the app's lifetime: keeps TCP/TLS connections (and
+    # HTTP/2 streams) warm across /pdf and Graph calls instead of paying a
+    # handshake per request.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        timeout=httpx.Timeout(120.0, connect=20.0),
+        headers={"User-Agent": "orders-mvp/1.0"},
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=100),
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+
+@app.on_event("startup")
+def warm_meta_cache():
+    try:
+        cols, flags = get_cached_meta()
+    except Exception:
+        # DB may not be reachable yet (compose startup order) — the cache
+        # will populate lazily on the first request instead.
+        return
+    # The DB answered, so a bad schema is a config error, not a race:
+    # fail the boot loudly instead of 500-ing on every request later.
+    if not flags["has_pk"]:
+        raise RuntimeError(f"PK column '{MSSQL_PK}' not found in table {MSSQL_TABLE}")
+    missing = [k for k in PATCH_ALLOWED_SQL if k not in _COLS_SET_CACHE]
+    if missing:
+        raise RuntimeError(f"Editable columns missing from {MSSQL_TABLE}: {missing}")
+
+
+@app.post("/admin/refresh-meta")
+async def refresh_meta():
+    def _q():
+        invalidate_meta_cache()
+        return get_cached_meta()
+
+    cols, flags = await run_db(_q)
+    return {"ok": True, "columns": cols, "column_flags": flags}
+
 
 @app.get("/health")
 def health():
@@ -150,9 +557,12 @@ def health():
 
 
 @app.get("/meta")
-def meta():
-    cols = fetch_table_columns()
-    return {
+async def meta(request: Request):
+    cols, _ = await run_db(get_cached_meta)
+    etag = weak_etag(cols)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    payload = {
         "table": MSSQL_TABLE,
         "pk": MSSQL_PK,
         "columns": cols,
@@ -164,21 +574,33 @@ def meta():
         },
         "pdf_max_pages_scan": PDF_MAX_PAGES_SCAN,
     }
+    return ORJSONResponse(payload, headers={"ETag": etag})
 
 
-@app.get("/diag")
-def diag():
-    cols = fetch_table_columns()
-    flags = validate_config_columns(cols)
-    table_sql = safe_table(MSSQL_TABLE)
+# DB_NAME() never changes within a process — resolve it once.
+_current_db_name: Optional[str] = None
 
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT DB_NAME()")
-        current_db = cur.fetchone()[0]
 
-        cur.execute(f"SELECT COUNT(1) FROM {table_sql};")
-        cnt = int(cur.fetchone()[0])
+@app.get("/diag")
+async def diag():
+    def _q():
+        global _current_db_name
+        cols, flags = get_cached_meta()
+
+        with get_conn() as conn:
+            if _current_db_name is None:
+                # One batch, two result sets: DB_NAME and the row count in a
+                # single round-trip.
+                cur = exec_prepared(conn, f"SELECT DB_NAME();\nSELECT COUNT_BIG(1) FROM {TABLE_SQL};", [])
+                _current_db_name = cur.fetchone()[0]
+                cur.nextset()
+                cnt = int(cur.fetchone()[0])
+            else:
+                cur = exec_prepared(conn, f"SELECT COUNT_BIG(1) FROM {TABLE_SQL};", [])
+                cnt = int(cur.fetchone()[0])
+        return flags, _current_db_name, cnt
+
+    flags, current_db, cnt = await run_db(_q)
 
     return {
         "mssql_server": MSSQL_SERVER,
@@ -195,19 +617,15 @@ def diag():
 
 @app.get("/diag_graph")
 def diag_graph():
-    drive_id = os.getenv("MS_DRIVE_ID") or ""
-    tenant_id = os.getenv("MS_TENANT_ID") or ""
-    client_id = os.getenv("MS_CLIENT_ID") or ""
-    client_secret = os.getenv("MS_CLIENT_SECRET") or ""
     return {
-        "has_ms_drive_id": bool(drive_id.strip()),
-        "ms_drive_id_prefix": (drive_id[:6] + "...") if drive_id.strip() else None,
-        "has_ms_tenant_id": bool(tenant_id.strip()),
-        "ms_tenant_id_prefix": (tenant_id[:6] + "...") if tenant_id.strip() else None,
-        "has_ms_client_id": bool(client_id.strip()),
-        "ms_client_id_prefix": (client_id[:6] + "...") if client_id.strip() else None,
-        "has_ms_client_secret": bool(client_secret.strip()),
-        "ms_client_secret_prefix": (client_secret[:3] + "...") if client_secret.strip() else None,
+        "has_ms_drive_id": bool(MS_DRIVE_ID),
+        "ms_drive_id_prefix": (MS_DRIVE_ID[:6] + "...") if MS_DRIVE_ID else None,
+        "has_ms_tenant_id": bool(MS_TENANT_ID),
+        "ms_tenant_id_prefix": (MS_TENANT_ID[:6] + "...") if MS_TENANT_ID else None,
+        "has_ms_client_id": bool(MS_CLIENT_ID),
+        "ms_client_id_prefix": (MS_CLIENT_ID[:6] + "...") if MS_CLIENT_ID else None,
+        "has_ms_client_secret": bool(MS_CLIENT_SECRET),
+        "ms_client_secret_prefix": (MS_CLIENT_SECRET[:3] + "...") if MS_CLIENT_SECRET else None,
     }
 
 
@@ -215,141 +633,251 @@ def diag_graph():
 # Orders endpoints
 # --------------------------
 @app.get("/orders")
-def list_orders(
+async def list_orders(
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=200),
     status: Optional[str] = Query(None),
     klient: Optional[str] = Query(None),
+    cursor: Optional[int] = Query(None, description="Last seen PK value; returns rows with PK < cursor"),
+    exact: bool = Query(False, description="Force an exact COUNT instead of the approximate/cached total"),
+    fields: Optional[str] = Query(None, description="Comma-separated columns to return (default: list projection)"),
 ):
-    cols = fetch_table_columns()
-    flags = validate_config_columns(cols)
+    cols, flags = await run_db(get_cached_meta)
 
     if not flags["has_pk"]:
         raise HTTPException(status_code=500, detail=f"PK column '{MSSQL_PK}' not found in table")
 
-    table_sql = safe_table(MSSQL_TABLE)
-    pk_sql = safe_ident(MSSQL_PK)
+    use_status = bool(status and flags["has_status"])
+    use_klient = bool(klient and flags["has_client"])
 
-    where = []
     params: List[Any] = []
-
-    if status and flags["has_status"]:
-        where.append(f"{safe_ident(STATUS_COLUMN)} = ?")
+    if use_status:
         params.append(status)
-
-    if klient and flags["has_client"]:
-        where.append(f"{safe_ident(CLIENT_COLUMN)} LIKE ?")
+    if use_klient:
         params.append(f"%{klient}%")
 
-    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
-    offset = (page - 1) * page_size
-
-    count_sql = f"SELECT COUNT(1) AS cnt FROM {table_sql}{where_sql};"
-    items_sql = (
-        f"SELECT * FROM {table_sql}{where_sql} "
-        f"ORDER BY {safe_ident('Klient')} ASC, {safe_ident('pdfFileName')} ASC, {safe_ident('Pozycja')} ASC "
-        f"OFFSET ? ROWS FETCH NEXT ? ROWS ONLY;"
-    )
+    select_list = orders_select_list(tuple(cols))
+    if fields:
+        existing = _COLS_SET_CACHE
+        wanted = [c.strip() for c in fields.split(",") if c.strip()]
+        if not wanted:
+            # e.g. ?fields=, — would otherwise build "SELECT  FROM ..."
+            raise HTTPException(status_code=400, detail="fields must name at least one column")
+        bad = [c for c in wanted if c not in existing]
+        if bad:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {bad}")
+        if cursor is not None and MSSQL_PK not in wanted:
+            # next_cursor needs the PK in the page
+            wanted.append(MSSQL_PK)
+        select_list = ", ".join(safe_ident(c) for c in wanted)
+
+    count_sql, items_sql, items_win_sql, seek_sql = build_orders_sql(select_list, use_status, use_klient)
+
+    notes = {
+        "status_filter_applied": use_status,
+        "client_filter_applied": use_klient,
+        "missing_columns_ignored": [k for k, v in flags.items() if k.startswith("has_") and not v],
+    }
 
-    with get_conn() as conn:
-        cur = conn.cursor()
+    if cursor is not None:
+        # Keyset ("seek") pagination: an index seek on the PK instead of
+        # OFFSET's scan-and-skip, so deep pages cost the same as page 1.
+        # No COUNT query — the client pages until next_cursor is null.
+        def _q():
+            with get_conn() as conn:
+                cur = exec_prepared(conn, seek_sql, [page_size] + params + [cursor])
+                return rows_to_dicts(cur, cur.fetchall())
+
+        items = await run_db(_q)
+
+        next_cursor = items[-1][MSSQL_PK] if len(items) == page_size else None
+        return {
+            "page_size": page_size,
+            "items": items,
+            "next_cursor": next_cursor,
+            "notes": notes,
+        }
 
-        cur.execute(count_sql, params)
-        total = int(cur.fetchone()[0])
+    offset = (page - 1) * page_size
 
-        cur.execute(items_sql, params + [offset, page_size])
-        rows = cur.fetchall()
-        items = [row_to_dict(cur, r) for r in rows]
+    def _q():
+        with get_conn() as conn:
+            if use_status or use_klient or exact:
+                # A recently cached total lets the plain page query run
+                # without the window — the filtered set isn't re-counted.
+                total = None if exact else count_cache_get(count_sql, params)
+                if total is not None:
+                    cur = exec_prepared(conn, items_sql, params + [offset, page_size])
+                    return total, rows_to_dicts(cur, cur.fetchall())
+
+                # A filtered (or forced-exact) total costs a scan of the
+                # filtered set anyway, so fuse it into the page query via
+                # COUNT(*) OVER() — one scan, one round-trip.
+                cur = exec_prepared(conn, items_win_sql, params + [offset, page_size])
+                items = rows_to_dicts(cur, cur.fetchall())
+                if items:
+                    total = int(items[0]["_total"])
+                    for it in items:
+                        del it["_total"]
+                else:
+                    # Page past the end: no window row came back.
+                    cur = exec_prepared(conn, count_sql, params)
+                    total = int(cur.fetchone()[0] or 0)
+                count_cache_put(count_sql, params, total)
+                return total, items
+
+            # Unfiltered: approximate total from partition stats, cached.
+            total = count_cache_get(APPROX_COUNT_SQL, [MSSQL_TABLE])
+            if total is None:
+                batch_sql = APPROX_COUNT_SQL + ";\n" + items_sql
+                cur = exec_prepared(conn, batch_sql, [MSSQL_TABLE] + params + [offset, page_size])
+                total = int(cur.fetchone()[0] or 0)
+                count_cache_put(APPROX_COUNT_SQL, [MSSQL_TABLE], total)
+                cur.nextset()
+                return total, rows_to_dicts(cur, cur.fetchall())
+
+            cur = exec_prepared(conn, items_sql, params + [offset, page_size])
+            return total, rows_to_dicts(cur, cur.fetchall())
+
+    total, items = await run_db(_q)
 
     return {
         "page": page,
         "page_size": page_size,
         "total": total,
         "items": items,
-        "notes": {
-            "status_filter_applied": bool(status and flags["has_status"]),
-            "client_filter_applied": bool(klient and flags["has_client"]),
-            "missing_columns_ignored": [k for k, v in flags.items() if k.startswith("has_") and not v],
-        },
+        "notes": notes,
     }
 
 
-@app.get("/orders/{id}")
-def get_order(id: int):
-    cols = fetch_table_columns()
-    flags = validate_config_columns(cols)
+@app.get("/orders.ndjson")
+def list_orders_ndjson(
+    status: Optional[str] = Query(None),
+    klient: Optional[str] = Query(None),
+):
+    # Streaming variant of /orders for exports: rows go out as they are
+    # fetched (NDJSON, one object per line), so memory stays O(batch) and
+    # the first bytes reach the client before the last row is read.
+    cols, flags = get_cached_meta()
 
     if not flags["has_pk"]:
         raise HTTPException(status_code=500, detail=f"PK column '{MSSQL_PK}' not found in table")
 
-    table_sql = safe_table(MSSQL_TABLE)
-    pk_sql = safe_ident(MSSQL_PK)
+    table_sql = TABLE_SQL
 
-    sql = f"SELECT * FROM {table_sql} WHERE {pk_sql} = ?;"
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(sql, (id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        return row_to_dict(cur, row)
+    where = []
+    params: List[Any] = []
 
+    if status and flags["has_status"]:
+        where.append(f"{STATUS_SQL} = ?")
+        params.append(status)
 
-@app.post("/orders/{id}/status")
-def set_status(id: int, status: str = Query(..., pattern="^(new|confirmed|rejected)$")):
-    cols = fetch_table_columns()
-    flags = validate_config_columns(cols)
+    if klient and flags["has_client"]:
+        where.append(f"{CLIENT_SQL} LIKE ?")
+        params.append(f"%{klient}%")
 
-    if not flags["has_pk"]:
-        raise HTTPException(status_code=500, detail=f"PK column '{MSSQL_PK}' not found in table")
-    if not flags["has_status"]:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Status column '{STATUS_COLUMN}' not found in table (add it or change STATUS_COLUMN env)",
-        )
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    items_sql = f"SELECT * FROM {table_sql}{where_sql} {ORDERS_ORDER_BY};"
+
+    def gen():
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.arraysize = FETCH_ARRAY_SIZE
+            cur.execute(items_sql, params)
+            colnames = [c[0] for c in cur.description]
+            while True:
+                batch = cur.fetchmany(FETCH_ARRAY_SIZE)
+                if not batch:
+                    break
+                for row in batch:
+                    yield orjson.dumps(dict(zip(colnames, row)), default=str) + b"\n"
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+
+@app.get("/orders/count")
+async def orders_count(exact: bool = Query(False)):
+    # O(1) total from partition stats by default; ?exact=1 runs a real
+    # COUNT_BIG scan. Lets the UI ask "how many rows" without paying the
+    # full /orders query.
+    def _q():
+        with get_conn() as conn:
+            if exact:
+                cur = exec_prepared(conn, f"SELECT COUNT_BIG(1) FROM {TABLE_SQL};", [])
+            else:
+                cur = exec_prepared(conn, APPROX_COUNT_SQL, [MSSQL_TABLE])
+            return int(cur.fetchone()[0] or 0)
+
+    total = await run_db(_q)
+    return {"table": MSSQL_TABLE, "count": total, "exact": exact}
 
-    table_sql = safe_table(MSSQL_TABLE)
-    pk_sql = safe_ident(MSSQL_PK)
-    status_sql = safe_ident(STATUS_COLUMN)
 
-    sql = f"UPDATE {table_sql} SET {status_sql} = ? WHERE {pk_sql} = ?;"
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(sql, (status, id))
-        conn.commit()
+@app.get("/orders/{id}")
+async def get_order(id: int, request: Request):
+    def _q():
+        cols, flags = get_cached_meta()
 
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Not found")
+        if not flags["has_pk"]:
+            raise HTTPException(status_code=500, detail=f"PK column '{MSSQL_PK}' not found in table")
 
+        with get_conn() as conn:
+            cur = exec_prepared(conn, GET_ORDER_SQL, (id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Not found")
+            return row_to_dict(cur, row)
+
+    data = await run_db(_q)
+    # No rowversion column on the table, so hash the fetched row: a 304 hit
+    # still skips the JSON encode + transfer while the UI navigates around.
+    etag = weak_etag(data)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    return ORJSONResponse(jsonable_encoder(data), headers={"ETag": etag})
+
+
+@app.post("/orders/{id}/status")
+async def set_status(id: int, status: str = Query(..., pattern="^(new|confirmed|rejected)$")):
+    def _q():
+        cols, flags = get_cached_meta()
+
+        if not flags["has_pk"]:
+            raise HTTPException(status_code=500, detail=f"PK column '{MSSQL_PK}' not found in table")
+        if not flags["has_status"]:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Status column '{STATUS_COLUMN}' not found in table (add it or change STATUS_COLUMN env)",
+            )
+
+        with get_conn() as conn:
+            cur = exec_prepared(conn, UPDATE_STATUS_SQL, (status, id))
+            conn.commit()
+
+            if cur.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Not found")
+
+    await run_db(_q)
     return {"ok": True, "id": id, "status": status}
 
 @app.patch("/orders/{id}")
-def patch_order(id: int, payload: OrderUpdateRequest):
-    cols = fetch_table_columns()
-    s = set(cols)
+async def patch_order(id: int, payload: OrderUpdateRequest):
+    await run_db(get_cached_meta)
+    s = _COLS_SET_CACHE
 
     # PK musi istnieć
     if MSSQL_PK not in s:
         raise HTTPException(status_code=500, detail=f"PK column '{MSSQL_PK}' not found in table")
 
-    table_sql = safe_table(MSSQL_TABLE)
-    pk_sql = safe_ident(MSSQL_PK)
-
-    # Whitelist pól, które wolno edytować z UI
-    allowed = ["Klient", "FinalIndeks", "NazwaKlienta", "IloscKlienta", "CenaOfertowa"]
-    # Jeśli kiedyś: allowed.append("OfertaWaluta")
+    table_sql = TABLE_SQL
+    pk_sql = PK_SQL
 
-    # Pydantic v1/v2 kompatybilnie:
-    if hasattr(payload, "model_dump"):
-        data = payload.model_dump(exclude_unset=True)
-    else:
-        data = payload.dict(exclude_unset=True)
+    data = payload.model_dump(exclude_unset=True)
 
     if not data:
         raise HTTPException(status_code=400, detail="No fields to update")
 
-    # tylko dozwolone pola
-    data = {k: v for k, v in data.items() if k in allowed}
+    # Model fields == edytowalne pola, więc wystarczy filtr whitelisty.
+    data = {k: v for k, v in data.items() if k in PATCH_ALLOWED_SQL}
 
     if not data:
         raise HTTPException(status_code=400, detail="No allowed fields to update")
@@ -362,201 +890,420 @@ def patch_order(id: int, payload: OrderUpdateRequest):
     sets = []
     params: List[Any] = []
     for k, v in data.items():
-        sets.append(f"{safe_ident(k)} = ?")
+        sets.append(f"{PATCH_ALLOWED_SQL[k]} = ?")
         params.append(v)
 
-    sql = f"UPDATE {table_sql} SET " + ", ".join(sets) + f" WHERE {pk_sql} = ?;"
+    # OUTPUT INSERTED.* zwraca zaktualizowany rekord w tym samym statemencie
+    # (UI od razu widzi zmiany) — jeden round-trip zamiast UPDATE + SELECT.
+    sql = (f"UPDATE {table_sql} SET " + ", ".join(sets)
+           + f" OUTPUT INSERTED.* WHERE {pk_sql} = ?;")
     params.append(id)
 
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(sql, params)
-        conn.commit()
+    def _q():
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            row = cur.fetchone()
+            conn.commit()
 
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Not found")
+            if not row:
+                raise HTTPException(status_code=404, detail="Not found")
+            return row_to_dict(cur, row)
 
-        # zwróć zaktualizowany rekord (UI od razu widzi zmiany)
-        cur.execute(f"SELECT * FROM {table_sql} WHERE {pk_sql} = ?;", (id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found after update")
-        return row_to_dict(cur, row)
+    return await run_db(_q)
 
 # --------------------------
 # Microsoft Graph helpers
 # --------------------------
-_graph_token = {"value": None, "exp": 0}
+# monotonic clock (immune to NTP jumps); lock makes a refresh single-flight
+# so a burst of /pdf requests after expiry triggers one token POST, not N.
+_graph_token = {"value": None, "exp": 0.0}
+_graph_token_lock = asyncio.Lock()
 
 
-async def graph_token() -> str:
-    tenant_id = os.getenv("MS_TENANT_ID")
-    client_id = os.getenv("MS_CLIENT_ID")
-    client_secret = os.getenv("MS_CLIENT_SECRET")
+def _graph_token_valid() -> bool:
+    return bool(_graph_token["value"]) and time.monotonic() < _graph_token["exp"] - 60
+
 
-    if not (tenant_id and client_id and client_secret):
+async def graph_token() -> str:
+    if not (MS_TENANT_ID and MS_CLIENT_ID and MS_CLIENT_SECRET):
         raise HTTPException(
             status_code=500,
             detail="Missing Graph env: MS_TENANT_ID/MS_CLIENT_ID/MS_CLIENT_SECRET",
         )
 
-    now = int(time.time())
-    if _graph_token["value"] and now < _graph_token["exp"] - 60:
+    if _graph_token_valid():
         return _graph_token["value"]
 
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    data = {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "grant_type": "client_credentials",
-        "scope": "https://graph.microsoft.com/.default",
-    }
+    async with _graph_token_lock:
+        # Double-checked: another coroutine may have refreshed while we
+        # waited for the lock.
+        if _graph_token_valid():
+            return _graph_token["value"]
+
+        token_url = f"https://login.microsoftonline.com/{MS_TENANT_ID}/oauth2/v2.0/token"
+        data = {
+            "client_id": MS_CLIENT_ID,
+            "client_secret": MS_CLIENT_SECRET,
+            "grant_type": "client_credentials",
+            "scope": "https://graph.microsoft.com/.default",
+        }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.post(token_url, data=data)
+        r = await app.state.http.post(token_url, data=data, timeout=30.0)
 
-    if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"Graph token failed: HTTP {r.status_code} {r.text[:200]}")
+        if r.status_code >= 400:
+            raise HTTPException(status_code=502, detail=f"Graph token failed: HTTP {r.status_code} {r.text[:200]}")
 
-    j = r.json()
-    _graph_token["value"] = j["access_token"]
-    _graph_token["exp"] = now + int(j.get("expires_in", 3600))
-    return _graph_token["value"]
+        j = r.json()
+        _graph_token["value"] = j["access_token"]
+        _graph_token["exp"] = time.monotonic() + int(j.get("expires_in", 3600))
+        return _graph_token["value"]
 
 
+@lru_cache(maxsize=256)
 def to_graph_share_id(raw_url: str) -> str:
-    # Graph expects: u!{base64url(url)}
-    b = raw_url.encode("utf-8")
-    s = base64.b64encode(b).decode("ascii")
-    s = s.replace("+", "-").replace("/", "_").rstrip("=")
+    # Graph expects: u!{base64url(url)}; urlsafe_b64encode emits the -/_
+    # alphabet in one C pass. Cached — the same pdfWebUrl shows up on
+    # retries and repeated range requests.
+    s = base64.urlsafe_b64encode(raw_url.encode("utf-8")).rstrip(b"=").decode("ascii")
     return f"u!{s}"
 
 
-async def fetch_pdf_stream_graph_item(item_id: str, range_header: Optional[str] = None):
-    drive_id = os.getenv("MS_DRIVE_ID")
-    if not drive_id:
-        raise HTTPException(status_code=500, detail="Missing Graph env: MS_DRIVE_ID")
-
+async def _stream_graph_content(url: str, range_header: Optional[str], error_label: str,
+                                if_none_match: Optional[str] = None):
+    # Stream, don't buffer: TTFB becomes "first 64 KB" instead of "full
+    # download", and peak memory per request is one chunk rather than the
+    # whole PDF. The first chunk is sniffed before anything is relayed.
     token = await graph_token()
-    url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{quote(item_id)}/content"
 
-    req_headers = {
-        "Authorization": f"Bearer {token}",
-        "User-Agent": "orders-mvp/1.0",
-    }
+    req_headers = {"Authorization": f"Bearer {token}"}
     if range_header:
         req_headers["Range"] = range_header
+    if if_none_match:
+        req_headers["If-None-Match"] = if_none_match
 
-    async with httpx.AsyncClient(
-        follow_redirects=True,
-        timeout=httpx.Timeout(120.0, connect=20.0),
-    ) as client:
-        r = await client.get(url, headers=req_headers)
+    client = app.state.http
+    req = client.build_request("GET", url, headers=req_headers)
+    r = await client.send(req, stream=True)
+
+    if r.status_code == 304:
+        # Client's copy is current; nothing to sniff or relay.
+        await r.aclose()
+        return None, r.headers, 304
 
     if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"Graph download failed: HTTP {r.status_code} {r.text[:200]}")
+        body = await r.aread()
+        await r.aclose()
+        detail = body[:200].decode("utf-8", errors="replace")
+        raise HTTPException(status_code=502, detail=f"{error_label}: HTTP {r.status_code} {detail}")
+
+    # Raw passthrough skips httpx's decoding layer; PDFs are served with
+    # identity encoding, so relay the wire bytes as-is. Fall back to the
+    # decoded iterator only if the origin ever compresses.
+    enc = (r.headers.get("content-encoding") or "identity").lower()
+    chunks = r.aiter_raw(65536) if enc == "identity" else r.aiter_bytes(65536)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b""
+    except Exception:
+        await r.aclose()
+        raise
 
     ctype = (r.headers.get("content-type") or "").lower()
-    first = r.content[:4] if r.content else b""
-    is_pdf = ("application/pdf" in ctype) or (first == b"%PDF")
+    is_pdf = ("application/pdf" in ctype) or first[:4] == b"%PDF"
     if not is_pdf:
+        await r.aclose()
         raise HTTPException(status_code=502, detail=f"Graph returned non-PDF (content-type={ctype or 'unknown'})")
 
-    async def gen():
-        yield r.content
-
+    async def gen(resp=r, first_chunk=first, rest=chunks):
+        try:
+            if first_chunk:
+                yield first_chunk
+            async for chunk in rest:
+                yield chunk
+        finally:
+            await resp.aclose()
+
+    # Closing a never-started generator skips its body (and the aclose in
+    # its finally), so expose the response for callers that bail out
+    # before iterating.
+    gen.upstream = r
     return gen, r.headers, r.status_code
 
 
-async def fetch_pdf_stream_graph_share(pdf_web_url: str, range_header: Optional[str] = None):
-    token = await graph_token()
-    share_id = to_graph_share_id(pdf_web_url)
-    url = f"https://graph.microsoft.com/v1.0/shares/{share_id}/driveItem/content"
-
-    req_headers = {
-        "Authorization": f"Bearer {token}",
-        "User-Agent": "orders-mvp/1.0",
-    }
-    if range_header:
-        req_headers["Range"] = range_header
-
-    async with httpx.AsyncClient(
-        follow_redirects=True,
-        timeout=httpx.Timeout(120.0, connect=20.0),
-    ) as client:
-        r = await client.get(url, headers=req_headers)
-
-    if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"Graph share download failed: HTTP {r.status_code} {r.text[:200]}")
+async def fetch_pdf_stream_graph_item(item_id: str, range_header: Optional[str] = None,
+                                      if_none_match: Optional[str] = None):
+    if not MS_DRIVE_ID:
+        raise HTTPException(status_code=500, detail="Missing Graph env: MS_DRIVE_ID")
 
-    ctype = (r.headers.get("content-type") or "").lower()
-    first = r.content[:4] if r.content else b""
-    is_pdf = ("application/pdf" in ctype) or (first == b"%PDF")
-    if not is_pdf:
-        raise HTTPException(status_code=502, detail=f"Graph returned non-PDF (content-type={ctype or 'unknown'})")
+    url = f"https://graph.microsoft.com/v1.0/drives/{MS_DRIVE_ID}/items/{quote(item_id)}/content"
+    return await _stream_graph_content(url, range_header, "Graph download failed", if_none_match)
 
-    async def gen():
-        yield r.content
 
-    return gen, r.headers, r.status_code
+async def fetch_pdf_stream_graph_share(pdf_web_url: str, range_header: Optional[str] = None,
+                                       if_none_match: Optional[str] = None):
+    share_id = to_graph_share_id(pdf_web_url)
+    url = f"https://graph.microsoft.com/v1.0/shares/{share_id}/driveItem/content"
+    return await _stream_graph_content(url, range_header, "Graph share download failed", if_none_match)
 
 
 # --------------------------
 # Legacy direct-url fetch (fallback)
 # --------------------------
 def candidate_download_urls(url: str) -> List[str]:
+    sep = "&" if "?" in url else "?"
     cands = [url]
-
     if "download=1" not in url:
-        if "?" in url:
-            cands.append(url + "&download=1")
-        else:
-            cands.append(url + "?download=1")
-
-    out = []
-    seen = set()
-    for u in cands:
-        if u not in seen:
-            out.append(u)
-            seen.add(u)
-    return out
+        cands.append(url + sep + "download=1")
+    if "raw=1" not in url:
+        cands.append(url + sep + "raw=1")
+    # dict.fromkeys dedupes in C while preserving order
+    return list(dict.fromkeys(cands))
 
 
 async def fetch_pdf_stream(url: str, range_header: Optional[str] = None):
-    timeout = httpx.Timeout(60.0, connect=20.0)
+    # Stream instead of buffering: the old client.get() held the whole PDF
+    # in memory and delayed the first byte until the download finished.
+    # Sniff the first chunk, then relay chunks as they arrive.
+    client = app.state.http
+
+    last_error = None
+    for u in candidate_download_urls(url):
+        req_headers = {"User-Agent": "orders-mvp/1.0"}
+        if range_header:
+            req_headers["Range"] = range_header
+
+        # Tiny probe first: auth-gated share links commonly answer with an
+        # HTML landing page, so sniff the first bytes before committing to
+        # the real GET. Streamed + closed after one read, so even an origin
+        # that ignores Range costs at most one chunk.
+        try:
+            preq = client.build_request("GET", u, headers={**req_headers, "Range": "bytes=0-7"})
+            pr = await client.send(preq, stream=True)
+        except Exception as e:
+            last_error = str(e)
+            continue
+        try:
+            pfirst = b""
+            async for b in pr.aiter_bytes(8):
+                pfirst = b
+                break
+        except Exception as e:
+            last_error = str(e)
+            continue
+        finally:
+            # The probe is read-once: close it whether the read worked or
+            # died mid-stream, or the connection leaks from the pool.
+            await pr.aclose()
+
+        pctype = (pr.headers.get("content-type") or "").lower()
+        if pr.status_code >= 400 or not (pfirst.startswith(b"%PDF") or "application/pdf" in pctype):
+            last_error = f"Probe rejected candidate (HTTP {pr.status_code}, content-type={pctype or 'unknown'})"
+            continue
 
-    async with httpx.AsyncClient(follow_redirects=True, timeout=timeout) as client:
-        last_error = None
-        for u in candidate_download_urls(url):
+        try:
+            req = client.build_request("GET", u, headers=req_headers)
+            r = await client.send(req, stream=True)
+        except Exception as e:
+            last_error = str(e)
+            continue
+
+        if r.status_code >= 400:
+            last_error = f"HTTP {r.status_code}"
+            await r.aclose()
+            continue
+
+        chunks = r.aiter_bytes(65536)
+        try:
+            first = await anext(chunks, b"")
+        except Exception as e:
+            last_error = str(e)
+            await r.aclose()
+            continue
+
+        ctype = (r.headers.get("content-type") or "").lower()
+        is_pdf = ("application/pdf" in ctype) or first[:4] == b"%PDF"
+        if not is_pdf:
+            last_error = f"Not a PDF (content-type={ctype or 'unknown'})"
+            await r.aclose()
+            continue
+
+        async def gen(resp=r, first_chunk=first, rest=chunks):
             try:
-                req_headers = {"User-Agent": "orders-mvp/1.0"}
-                if range_header:
-                    req_headers["Range"] = range_header
-
-                r = await client.get(u, headers=req_headers)
-
-                ctype = (r.headers.get("content-type") or "").lower()
-                first = r.content[:4] if r.content else b""
-                is_pdf = ("application/pdf" in ctype) or (first == b"%PDF")
+                if first_chunk:
+                    yield first_chunk
+                async for chunk in rest:
+                    yield chunk
+            finally:
+                await resp.aclose()
 
-                if r.status_code >= 400:
-                    last_error = f"HTTP {r.status_code}"
-                    continue
+        # See _stream_graph_content: lets callers close the stream without
+        # starting the generator.
+        gen.upstream = r
+        return gen, r.headers, r.status_code
 
-                if not is_pdf:
-                    last_error = f"Not a PDF (content-type={ctype or 'unknown'})"
-                    continue
+    raise HTTPException(status_code=502, detail=f"Could not fetch PDF from url. Last error: {last_error}")
 
-                async def gen():
-                    yield r.content
 
-                return gen, r.headers, r.status_code
+# --------------------------
+# PDF body cache
+# --------------------------
+# PDF.js issues many small Range requests per document; without a cache each
+# one re-downloads from Graph. Keep recently served PDFs in memory (LRU with
+# a total-bytes budget) and serve Range slices from RAM. Oversize items and
+# bodies with unknown length bypass the cache and stream as before.
+_pdf_cache: "OrderedDict[str, Tuple[bytes, Dict[str, str]]]" = OrderedDict()
+_pdf_cache_bytes = 0
+_pdf_key_locks: Dict[str, asyncio.Lock] = {}
+# Keys that turned out uncacheable (unknown or oversize body). Without this
+# every Range request for a large PDF would first open and abort a full GET
+# just to re-learn the size before doing the real ranged fetch.
+_pdf_uncacheable: set = set()
+
+
+def _pdf_mark_uncacheable(key: str) -> None:
+    if len(_pdf_uncacheable) >= 4096:
+        _pdf_uncacheable.clear()
+    _pdf_uncacheable.add(key)
+
+
+def _pdf_cache_get(key: str) -> Optional[Tuple[bytes, Dict[str, str]]]:
+    ent = _pdf_cache.get(key)
+    if ent is not None:
+        _pdf_cache.move_to_end(key)
+    return ent
+
+
+def _pdf_cache_put(key: str, body: bytes, headers: Dict[str, str]) -> None:
+    global _pdf_cache_bytes
+    if len(body) > PDF_CACHE_MAX_ITEM_BYTES or len(body) > PDF_CACHE_MAX_BYTES:
+        return
+    old = _pdf_cache.pop(key, None)
+    if old is not None:
+        _pdf_cache_bytes -= len(old[0])
+    _pdf_cache[key] = (body, headers)
+    _pdf_cache_bytes += len(body)
+    while _pdf_cache_bytes > PDF_CACHE_MAX_BYTES and _pdf_cache:
+        _, (evicted, _h) = _pdf_cache.popitem(last=False)
+        _pdf_cache_bytes -= len(evicted)
+
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range header against a known size.
+
+    Returns an inclusive (start, end) pair, or None for anything we don't
+    support (multi-range, malformed) — the caller then serves the full body,
+    which is always a valid response to a Range request.
+    """
+    m = _RANGE_RE.match(range_header.strip())
+    if not m:
+        return None
+    start_s, end_s = m.groups()
+    if start_s:
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    elif end_s:
+        # suffix form: last N bytes
+        start = max(0, size - int(end_s))
+        end = size - 1
+    else:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Weak comparison per RFC 9110: the W/ prefix is ignored and "*"
+    # matches anything.
+    def core(v: str) -> str:
+        v = v.strip()
+        return v[2:] if v.startswith("W/") else v
+
+    if if_none_match.strip() == "*":
+        return True
+    target = core(etag)
+    return any(core(c) == target for c in if_none_match.split(","))
+
+
+def _serve_cached_pdf(body: bytes, headers: Dict[str, str], range_header: Optional[str],
+                      if_none_match: Optional[str] = None) -> Response:
+    resp_headers = {
+        "Cache-Control": "no-store",
+        "Accept-Ranges": "bytes",
+    }
+    for src, dst in (("content-disposition", "Content-Disposition"),
+                     ("etag", "ETag"),
+                     ("last-modified", "Last-Modified")):
+        if src in headers:
+            resp_headers[dst] = headers[src]
 
-            except Exception as e:
-                last_error = str(e)
-                continue
+    if if_none_match and "etag" in headers and _etag_matches(if_none_match, headers["etag"]):
+        return Response(status_code=304, headers=resp_headers)
 
-        raise HTTPException(status_code=502, detail=f"Could not fetch PDF from url. Last error: {last_error}")
+    if range_header:
+        rng = _parse_range(range_header, len(body))
+        if rng is not None:
+            start, end = rng
+            resp_headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            return Response(
+                content=body[start:end + 1],
+                status_code=206,
+                media_type="application/pdf",
+                headers=resp_headers,
+            )
+    return Response(content=body, media_type="application/pdf", headers=resp_headers)
+
+
+async def _fetch_pdf_into_cache(key: str, id: Optional[str], url: Optional[str]) -> Optional[Tuple[bytes, Dict[str, str]]]:
+    """Fetch the full PDF and store it; None means "stream it instead".
+
+    Mirrors pdf_proxy's source-selection order (Graph item, Graph share,
+    legacy URL) but always requests the whole body — slices are cut from
+    memory afterwards. Bails out without consuming the stream when the
+    origin reports an uncacheable size.
+    """
+    if id:
+        try:
+            gen, headers, _status = await fetch_pdf_stream_graph_item(id)
+        except HTTPException as e:
+            msg = str(e.detail) if hasattr(e, "detail") else ""
+            if url and ("itemNotFound" in msg or "HTTP 404" in msg):
+                gen, headers, _status = await fetch_pdf_stream_graph_share(url)
+            else:
+                raise
+    elif url:
+        gen, headers, _status = await fetch_pdf_stream(url)
+    else:
+        return None
+
+    clen = headers.get("content-length")
+    if clen is None or not clen.isdigit() or int(clen) > PDF_CACHE_MAX_ITEM_BYTES:
+        # aclose() on an unstarted generator never enters its body, so the
+        # response must be closed directly or its pool connection leaks.
+        await gen.upstream.aclose()
+        _pdf_mark_uncacheable(key)
+        return None
+
+    buf = io.BytesIO()
+    agen = gen()
+    try:
+        async for chunk in agen:
+            buf.write(chunk)
+            if buf.tell() > PDF_CACHE_MAX_ITEM_BYTES:
+                # Origin lied about content-length; don't cache it.
+                _pdf_mark_uncacheable(key)
+                return None
+    finally:
+        await agen.aclose()
+    body = buf.getvalue()
+    kept = {k: headers[k] for k in ("content-disposition", "etag", "last-modified") if k in headers}
+    _pdf_cache_put(key, body, kept)
+    return body, kept
 
 
 # --------------------------
@@ -569,8 +1316,39 @@ async def pdf_proxy(
     id: Optional[str] = Query(None),
 ):
     range_header = request.headers.get("range")
+    if_none_match = request.headers.get("if-none-match")
+
+    cache_key = f"id:{id}" if id else (f"url:{url}" if url else None)
+    if cache_key and PDF_CACHE_MAX_BYTES > 0 and cache_key not in _pdf_uncacheable:
+        ent = _pdf_cache_get(cache_key)
+        if ent is None:
+            # Coalesce concurrent misses for the same document: one request
+            # downloads, the rest wait on the key lock and hit the cache.
+            lock = _pdf_key_locks.setdefault(cache_key, asyncio.Lock())
+            try:
+                async with lock:
+                    ent = _pdf_cache_get(cache_key)
+                    if ent is None:
+                        ent = await _fetch_pdf_into_cache(cache_key, id, url)
+            finally:
+                # Also on a failed fetch (e.g. bad ?url= → 502): the keys
+                # are client-supplied, so entries must not outlive waiters.
+                if not lock.locked():
+                    _pdf_key_locks.pop(cache_key, None)
+        if ent is not None:
+            body, cached_headers = ent
+            return _serve_cached_pdf(body, cached_headers, range_header, if_none_match)
+
+    async def build_response(gen, headers: Dict[str, str], upstream_status: int):
+        if upstream_status == 304:
+            # Upstream confirmed the client's copy; relay the validators.
+            not_modified = {}
+            if "etag" in headers:
+                not_modified["ETag"] = headers["etag"]
+            if "last-modified" in headers:
+                not_modified["Last-Modified"] = headers["last-modified"]
+            return Response(status_code=304, headers=not_modified)
 
-    def build_response(gen, headers: Dict[str, str], upstream_status: int):
         resp_headers = {
             "Cache-Control": "no-store",
             "Accept-Ranges": "bytes",
@@ -579,25 +1357,60 @@ async def pdf_proxy(
             resp_headers["Content-Disposition"] = headers["content-disposition"]
         if "content-range" in headers:
             resp_headers["Content-Range"] = headers["content-range"]
+        # Forward validators so the browser can revalidate with 304s.
+        if "etag" in headers:
+            resp_headers["ETag"] = headers["etag"]
+        if "last-modified" in headers:
+            resp_headers["Last-Modified"] = headers["last-modified"]
         if "content-length" in headers:
             resp_headers["Content-Length"] = headers["content-length"]
+            # Early reject when the origin already tells us it's too big.
+            try:
+                too_big = int(headers["content-length"]) > PDF_MAX_BYTES
+            except ValueError:
+                too_big = False
+            if too_big:
+                # The stream is already open (the sniff read its first
+                # chunk); close it before raising or the pool slot leaks.
+                await gen.upstream.aclose()
+                raise HTTPException(status_code=413, detail="PDF exceeds PDF_MAX_BYTES")
+
+        async def bounded():
+            # Cap relayed bytes and bound each upstream read so a slow or
+            # malicious origin can't hold memory/connections indefinitely.
+            total = 0
+            it = gen().__aiter__()
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(it.__anext__(), timeout=PDF_CHUNK_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    total += len(chunk)
+                    if total > PDF_MAX_BYTES:
+                        raise HTTPException(status_code=413, detail="PDF exceeds PDF_MAX_BYTES")
+                    yield chunk
+            finally:
+                await it.aclose()
 
         status_code = 206 if range_header and upstream_status == 206 else 200
-        return StreamingResponse(gen(), media_type="application/pdf", headers=resp_headers, status_code=status_code)
+        return StreamingResponse(bounded(), media_type="application/pdf", headers=resp_headers, status_code=status_code)
 
     # Prefer Graph by item id (secure)
     if id:
         # 1) try driveId + itemId
         try:
-            gen, headers, upstream_status = await fetch_pdf_stream_graph_item(id, range_header=range_header)
-            return build_response(gen, headers, upstream_status)
+            gen, headers, upstream_status = await fetch_pdf_stream_graph_item(
+                id, range_header=range_header, if_none_match=if_none_match)
+            return await build_response(gen, headers, upstream_status)
         except HTTPException as e:
             msg = str(e.detail) if hasattr(e, "detail") else ""
             is_item_not_found = "itemNotFound" in msg or "HTTP 404" in msg
 
             if is_item_not_found and url:
-                gen2, headers2, upstream_status2 = await fetch_pdf_stream_graph_share(url, range_header=range_header)
-                return build_response(gen2, headers2, upstream_status2)
+                gen2, headers2, upstream_status2 = await fetch_pdf_stream_graph_share(
+                    url, range_header=range_header, if_none_match=if_none_match)
+                return await build_response(gen2, headers2, upstream_status2)
 
             raise
 
@@ -606,10 +1419,14 @@ async def pdf_proxy(
         raise HTTPException(status_code=400, detail="Provide either ?id=... or ?url=...")
 
     gen, headers, upstream_status = await fetch_pdf_stream(url, range_header=range_header)
-    return build_response(gen, headers, upstream_status)
-
-
-
-
+    return await build_response(gen, headers, upstream_status)
 
 
+# Guard against a route being registered twice (e.g. a stray duplicated
+# block after a bad merge): every (path, methods) pair must be unique.
+_seen_routes = set()
+for _route in app.routes:
+    _key = (_route.path, tuple(sorted(getattr(_route, "methods", None) or ())))
+    assert _key not in _seen_routes, f"Duplicate route registration: {_key}"
+    _seen_routes.add(_key)
+del _seen_routes, _route, _key